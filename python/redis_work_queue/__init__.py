@@ -1,3 +1,3 @@
-from .item import Item
+from .item import Item, set_codec, use_json, use_msgpack, use_orjson
 from .keyprefix import KeyPrefix
 from .workqueue import WorkQueue
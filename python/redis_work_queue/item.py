@@ -1,28 +1,132 @@
-import uuid
 import json
+import os
 
 
-class Item(dict):
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+_loads = json.loads
+
+# The codec used by `Item.from_json_data` and `Item.data_json`, see `set_codec`.
+_encode = _dumps
+_decode = _loads
+
+
+def set_codec(encode, decode) -> None:
+    """Set the codec used by `Item.from_json_data` and `Item.data_json` to serialize and parse item
+    data. This defaults to JSON, `use_json` restores the default.
+
+    Args:
+        encode: Function converting an object to `bytes` (or `str`).
+        decode: Function converting `bytes` back to an object.
+    """
+    global _encode, _decode
+    _encode = encode
+    _decode = decode
+
+
+def use_json() -> None:
+    """Use the standard library's JSON to serialize and parse item data. This is the default codec,
+    so it undoes `set_codec`, `use_orjson` and `use_msgpack`."""
+    set_codec(_dumps, _loads)
+
+
+def use_orjson() -> None:
+    """Use [orjson](https://pypi.org/project/orjson/) to serialize and parse item data as JSON, see
+    `set_codec`. This is much faster than the standard library.
+
+    Non-string dict keys are allowed, as with the standard library, and data orjson can't
+    serialize (such as integers beyond 64 bits) falls back to the standard library. Non-ASCII text
+    is written as UTF-8 rather than escaped, so the data bytes can differ from the default codec.
+    """
+    import orjson
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return _dumps(obj)
+
+    set_codec(dumps, orjson.loads)
+
+
+def use_msgpack() -> None:
+    """Use [msgpack](https://pypi.org/project/msgpack/) as the codec for item data, see
+    `set_codec`. This is more compact, and faster, than JSON."""
+    import msgpack
+    set_codec(msgpack.packb, msgpack.unpackb)
+
+
+# Converts item data, by exact type, to bytes. Other types are handled by `_coerce_data`.
+_DATA_COERCE = {
+    bytes: lambda data: data,
+    str: str.encode,
+    bytearray: bytes,
+}
+
+
+def _coerce_data(data) -> bytes:
+    """Convert item data of a type not in `_DATA_COERCE` (such as a `str` subclass) to bytes."""
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return bytes(data)
+
+
+def _id_bytes(id: str | bytes) -> bytes:
+    """Get an item id as bytes."""
+    return id if type(id) is bytes else id.encode('utf-8')
+
+
+def _new_id() -> str:
+    """Generate a new random ID, formatted like `uuid.uuid4().hex` but without building a
+    `UUID`."""
+    return os.urandom(16).hex()
+
+
+class Item(object):
     """An item for a work queue. Each item has an ID and associated data."""
 
+    __slots__ = ('_data', '_id', '_key_cache')
+
     def __init__(self, data: bytes | str, id=None):
         """
         Args:
             data (bytes or str): Data to associate with this item, strings will be converted to
                                  bytes.
-            id (str | None): ID of the Item, if None, a new (random UUID) ID is generated.
+            id (str | bytes | None): ID of the Item, if None, a new (random) ID is generated.
+                                     Items leased from a work queue have the id returned by
+                                     redis, which is normally bytes.
         """
-        if isinstance(data, str):
-            data = bytes(data, 'utf-8')
-        elif not isinstance(data, bytes):
-            data = bytes(data)
+        data = _DATA_COERCE.get(type(data), _coerce_data)(data)
 
         if id is None:
-            id = uuid.uuid4().hex
-        elif type(id) != str:
+            id = _new_id()
+        elif type(id) is not str and type(id) is not bytes:
             id = str(id)
 
-        dict.__init__(self, data=data, id=id)
+        self._data = data
+        self._id = id
+        # Set by `WorkQueue` to the work queue the keys were generated for, the lease key, and the
+        # item data key.
+        self._key_cache = None
+
+    def __getitem__(self, key: str):
+        """Get 'data' or 'id' by key, for compatibility with when `Item` was a `dict`."""
+        if key == 'data':
+            return self._data
+        if key == 'id':
+            return self._id
+        raise KeyError(key)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Item):
+            return NotImplemented
+        # Items leased from a work queue have bytes ids, so compare ids as bytes.
+        return _id_bytes(self._id) == _id_bytes(other._id) and self._data == other._data
+
+    def __repr__(self) -> str:
+        return f'Item(data={self._data!r}, id={self._id!r})'
 
     @classmethod
     def from_dict(cls, loaded: dict):
@@ -36,21 +140,23 @@ class Item(dict):
     def parse(cls, s: str):
         """Parse an `Item` from JSON. The JSON structure should be an object with a 'data' key and,
         optionally, an 'id' key."""
-        return cls.from_dict(json.loads(s))
+        return cls.from_dict(_loads(s))
 
     @classmethod
     def from_json_data(cls, data, id=None):
-        """Generate an item where the associated data is the JSON string of `data`."""
-        return cls(json.dumps(data, separators=(',', ':')), id=id)
+        """Generate an item where the associated data is `data` serialized as JSON (or with the
+        codec set by `set_codec`)."""
+        return cls(_encode(data), id=id)
 
     def data(self) -> bytes:
         """Get the data associated with this item."""
-        return self['data']
+        return self._data
 
     def data_json(self):
-        """Get the data associated with this item, parsed as JSON."""
-        return json.loads(self.data())
+        """Get the data associated with this item, parsed as JSON (or with the codec set by
+        `set_codec`)."""
+        return _decode(self._data)
 
-    def id(self) -> str:
+    def id(self) -> str | bytes:
         """Get the ID of the item."""
-        return self['id']
+        return self._id
@@ -1,3 +1,6 @@
+import sys
+
+
 class KeyPrefix:
     """A string which should be prefixed to an identifier to generate a database key.
 
@@ -14,10 +17,14 @@ class KeyPrefix:
     """
 
     def __init__(self, prefix: str):
-        self.prefix = prefix
+        self.prefix = sys.intern(prefix)
+        self._prefix_bytes = prefix.encode('utf-8')
 
-    def of(self, name: str) -> str:
-        """Returns the result of prefixing `self` onto `name`."""
+    def of(self, name: str | bytes) -> str | bytes:
+        """Returns the result of prefixing `self` onto `name`. If `name` is bytes, so is the
+        result."""
+        if type(name) is bytes:
+            return self._prefix_bytes + name
         return self.prefix + name
 
     @classmethod
@@ -1,41 +1,205 @@
-import uuid
+import logging
+from collections.abc import Iterable
 from redis import Redis
 from redis.client import Pipeline
+from redis.commands.core import Script
+from redis.exceptions import ResponseError
 
 from redis_work_queue import Item
+from redis_work_queue.item import _new_id
 from redis_work_queue import KeyPrefix
 
+log = logging.getLogger(__name__)
+
 
 class WorkQueue(object):
     """A work queue backed by a redis database"""
 
+    # KEYS: item data key, main queue.
+    # ARGV: item data, item id.
+    # The data is set before the id is pushed, and since scripts are atomic, no worker can see the
+    # id before its data is ready.
+    _ADD_ITEM_LUA = """
+redis.call('SET', KEYS[1], ARGV[1])
+return redis.call('LPUSH', KEYS[2], ARGV[2])
+"""
+
+    # KEYS: processing list, item data key, lease key.
+    # ARGV: item id.
+    # Only delete the data and lease if the item was still in the processing list. If it wasn't,
+    # it's probably been returned to the work queue so the data is still needed and the lease might
+    # not be ours (if it is still ours, it'll expire anyway).
+    _COMPLETE_LUA = """
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+if removed > 0 then
+    redis.call('DEL', KEYS[2], KEYS[3])
+end
+return removed
+"""
+
+    # KEYS: main queue, processing list.
+    # ARGV: lease key prefix, item data key prefix, lease duration (seconds), session, and 1 to use
+    # LMOVE (redis 6.2+) or 0 to use RPOPLPUSH.
+    # Returns nil if the main queue is empty, otherwise the leased item id and its data.
+    _LEASE_LUA = """
+local item_id
+if ARGV[5] == '1' then
+    item_id = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+else
+    item_id = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+end
+if not item_id then
+    return nil
+end
+local data = redis.call('GET', ARGV[2] .. item_id)
+redis.call('SETEX', ARGV[1] .. item_id, ARGV[3], ARGV[4])
+return {item_id, data or ''}
+"""
+
+    # KEYS: processing list, cleaning list, main queue.
+    # ARGV: lease key prefix, item data key prefix, and the number of ids to read from the
+    # processing list at a time.
+    # Returns the ids which were moved back to the main queue from the processing list, and those
+    # which were moved back after being left in the cleaning list.
+    _LIGHT_CLEAN_LUA = """
+local call, insert = redis.call, table.insert
+local processing, cleaning, main_queue = KEYS[1], KEYS[2], KEYS[3]
+local lease_prefix, item_data_prefix, chunk = ARGV[1], ARGV[2], tonumber(ARGV[3])
+
+-- If the lease key is not present for an item (it expired or was never created because the
+-- client crashed before creating it) then move the item back to the main queue so others can work
+-- on it.
+-- The processing list is read a chunk at a time, splitting it into the ids which are kept and those
+-- which have expired. If any expired, the list is rebuilt from the kept ids, rather than removing
+-- each expired id with LREM (which scans the whole list every time).
+-- Lua 5.1's `unpack` fails beyond about 8000 values, so ids are pushed back in batches of at most
+-- `push_batch`, whatever the read chunk is.
+local push_batch = math.min(chunk, 1000)
+local kept, reset, seen = {}, {}, {}
+local start = 0
+repeat
+    local item_ids = call('LRANGE', processing, start, start + chunk - 1)
+    for _, item_id in ipairs(item_ids) do
+        if call('EXISTS', lease_prefix .. item_id) == 1 then
+            insert(kept, item_id)
+        elseif not seen[item_id] then
+            seen[item_id] = true
+            insert(reset, item_id)
+        end
+    end
+    start = start + chunk
+until #item_ids < chunk
+if #reset > 0 then
+    call('DEL', processing)
+    for first = 1, #kept, push_batch do
+        call('RPUSH', processing, unpack(kept, first, math.min(first + push_batch - 1, #kept)))
+    end
+    for first = 1, #reset, push_batch do
+        call('LPUSH', main_queue, unpack(reset, first, math.min(first + push_batch - 1, #reset)))
+    end
+end
+
+-- Older cleaners (and the other implementations) store items in the cleaning list while they move
+-- them. If one crashed, the item may not be in any queue, so put it back. Items without data have
+-- been completed, so they're dropped.
+local lost = {}
+local forgot = call('LRANGE', cleaning, 0, -1)
+if #forgot > 0 then
+    -- Look up which ids are queued in a table, rather than scanning both lists (with LPOS) for
+    -- every forgotten id.
+    local queued = {}
+    for _, list in ipairs({main_queue, processing}) do
+        for _, item_id in ipairs(call('LRANGE', list, 0, -1)) do
+            queued[item_id] = true
+        end
+    end
+    for _, item_id in ipairs(forgot) do
+        if not queued[item_id]
+                and call('EXISTS', lease_prefix .. item_id) == 0
+                and call('EXISTS', item_data_prefix .. item_id) == 1 then
+            call('LPUSH', main_queue, item_id)
+            queued[item_id] = true
+            insert(lost, item_id)
+        end
+        call('LREM', cleaning, 0, item_id)
+    end
+end
+
+return {reset, lost}
+"""
+
     def __init__(self, name: KeyPrefix):
-        self._session = uuid.uuid4().hex
+        self._session = _new_id()
         self._main_queue_key = name.of(':queue')
         self._processing_key = name.of(':processing')
         self._cleaning_key = name.of(':cleaning')
         self._lease_key = KeyPrefix.concat(name, ':leased_by_session:')
         self._item_data_key = KeyPrefix.concat(name, ':item:')
+        # Whether the server supports LMOVE and BLMOVE, checked the first time it's needed.
+        self._has_lmove: bool | None = None
+        # The Lua scripts, registered the first time they're used. Each is sent to the server with
+        # EVALSHA, and reloaded automatically if the server doesn't have it (e.g. after a restart).
+        self._scripts: dict[str, Script] = {}
+
+    @classmethod
+    def recommended_redis(cls, url: str, **kwargs) -> Redis:
+        """Connect to the redis server at `url` with settings suited to a work queue.
+
+        TCP keepalive is enabled so idle connections (such as those blocked in `lease`) aren't
+        silently dropped, connections are health checked after 30 seconds idle, and the pool is
+        limited to 64 connections. Any of these can be overridden with `kwargs`, which are passed to
+        `Redis.from_url`.
+
+        redis-py always sets `TCP_NODELAY`, so small commands aren't delayed by Nagle's algorithm.
+        """
+        options = {
+            'socket_keepalive': True,
+            'health_check_interval': 30,
+            'max_connections': 64,
+        }
+        options.update(kwargs)
+        return Redis.from_url(url, **options)
 
     def add_item_to_pipeline(self, pipeline: Pipeline, item: Item) -> None:
         """Add an item to the work queue. This adds the redis commands onto the pipeline passed.
 
         Use `WorkQueue.add_item` if you don't want to pass a pipeline directly.
         """
+        _, item_data_key = self._keys_for(item)
         # Add the item data
-        # NOTE: it's important that the data is added first, otherwise someone before the data is
-        # ready
-        pipeline.set(self._item_data_key.of(item.id()), item.data())
+        # NOTE: it's important that the data is added first, otherwise someone could pop the item
+        # before the data is ready. The commands in a pipeline run in order, so this holds even
+        # without a transaction. (Plain commands are used, rather than the add item script, so the
+        # pipeline doesn't have to check the script is loaded before every execute.)
+        pipeline.set(item_data_key, item.data())
         # Then add the id to the work queue
         pipeline.lpush(self._main_queue_key, item.id())
 
     def add_item(self, db: Redis, item: Item) -> None:
         """Add an item to the work queue.
 
-        This creates a pipeline and executes it on the database.
+        The data is set and the id pushed atomically, by a Lua script, in a single round trip.
+        """
+        _, item_data_key = self._keys_for(item)
+        self._script(db, self._ADD_ITEM_LUA)(
+            keys=[item_data_key, self._main_queue_key],
+            args=[item.data(), item.id()],
+            client=db,
+        )
+
+    def add_items(self, db: Redis, items: Iterable[Item], chunk: int = 10000) -> None:
+        """Add many items to the work queue.
+
+        The items are sent in pipelines of up to `chunk` items, so adding lots of items doesn't
+        take a round trip per item, or build up an unbounded reply buffer.
         """
-        pipeline = db.pipeline()
-        self.add_item_to_pipeline(pipeline, item)
+        if chunk < 1:
+            raise ValueError(f'chunk must be at least 1, got {chunk}')
+        pipeline = db.pipeline(transaction=False)
+        for i, item in enumerate(items, 1):
+            self.add_item_to_pipeline(pipeline, item)
+            if i % chunk == 0:
+                pipeline.execute()
         pipeline.execute()
 
     def queue_len(self, db: Redis) -> int:
@@ -47,47 +211,68 @@ class WorkQueue(object):
         """Return the number of items being processed."""
         return db.llen(self._processing_key)
 
-    def light_clean(self, db: Redis) -> None:
-        processing: list[bytes | str] = db.lrange(
-            self._processing_key, 0, -1)
-        for item_id in processing:
-            if isinstance(item_id, bytes):
-                item_id = item_id.decode('utf-8')
-            # If the lease key is not present for an item (it expired or was never created because
-            # the client crashed before creating it) then move the item back to the main queue so
-            # others can work on it.
-            if not self._lease_exists(db, item_id):
-                print(item_id, 'has no lease')
-                # While working on an item, we store it in the cleaning list. If we ever crash, we
-                # come back and check these items.
-                db.lpush(self._cleaning_key, item_id)
-                removed = int(db.lrem(self._processing_key, 0, item_id))
-                if removed > 0:
-                    db.lpush(self._main_queue_key, item_id)
-                    print(item_id, 'was still in the processing queue, it was reset')
-                else:
-                    print(item_id, 'was no longer in the processing queue')
-                db.lrem(self._cleaning_key, 0, item_id)
-
-        # Now we check the
-        forgot: list[bytes | str] = db.lrange(self._cleaning_key, 0, -1)
-        for item_id in forgot:
-            if isinstance(item_id, bytes):
-                item_id = item_id.decode('utf-8')
-            print(item_id, 'was forgotten in clean')
-            if not self._lease_exists(db, item_id) and \
-                    db.lpos(self._main_queue_key, item_id) is None and \
-                    db.lpos(self._processing_key, item_id) is None:
-                # FIXME: this introcudes a race
-                # maybe not anymore
-                # no, it still does, what if the job has been completed?
-                db.lpush(self._main_queue_key, item_id)
-                print(item_id, 'was not in any queue, it was reset')
-            db.lrem(self._cleaning_key, 0, item_id)
-
-    def _lease_exists(self, db: Redis, item_id: str) -> bool:
-        """True iff a lease on 'item_id' exists."""
-        return db.exists(self._lease_key.of(item_id)) != 0
+    def light_clean(self, db: Redis, chunk: int = 1000) -> None:
+        """Move items whose lease has expired (or was never created) back to the main queue, so
+        other workers can pick them up.
+
+        The whole clean runs as a single Lua script, so it's atomic with respect to other clients
+        and takes one round trip.
+
+        The processing list is read `chunk` ids at a time, which bounds the size of each LRANGE
+        reply. It doesn't bound the script's memory: the ids being kept are all held while the list
+        is scanned, so it can be rewritten if any items are reset.
+        """
+        if chunk < 1:
+            raise ValueError(f'chunk must be at least 1, got {chunk}')
+        reset, lost = self._script(db, self._LIGHT_CLEAN_LUA)(
+            keys=[self._processing_key, self._cleaning_key, self._main_queue_key],
+            args=[self._lease_key.prefix, self._item_data_key.prefix, chunk],
+            client=db,
+        )
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        debug = log.debug
+        for item_id in reset:
+            debug('%s had no lease, it was reset', item_id)
+        for item_id in lost:
+            debug('%s was forgotten in clean, it was reset', item_id)
+
+    def _keys_for(self, item: Item) -> tuple[str | bytes, str | bytes]:
+        """Get the lease key and item data key of `item`.
+
+        These are needed by most operations, so they're cached on the item rather than rebuilt.
+        """
+        cache = item._key_cache
+        if cache is None or cache[0] is not self:
+            item_id = item.id()
+            cache = item._key_cache = (
+                self,
+                self._lease_key.of(item_id),
+                self._item_data_key.of(item_id),
+            )
+        return cache[1], cache[2]
+
+    def _script(self, db: Redis | Pipeline, source: str) -> Script:
+        """Get the registered `Script` for the Lua `source`, registering it on first use."""
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = db.register_script(source)
+        return script
+
+    def _supports_lmove(self, db: Redis) -> bool:
+        """True iff the server supports LMOVE and BLMOVE, which replace the deprecated RPOPLPUSH
+        and BRPOPLPUSH in redis 6.2.
+
+        If the version can't be read (INFO is often denied by ACLs, and some proxies don't support
+        it), the older commands are used, since they work everywhere."""
+        if self._has_lmove is None:
+            try:
+                version = db.info('server')['redis_version']
+                major, minor = (int(part) for part in version.split('.')[:2])
+                self._has_lmove = (major, minor) >= (6, 2)
+            except (ResponseError, KeyError, ValueError):
+                self._has_lmove = False
+        return self._has_lmove
 
     def lease(self, db: Redis, lease_secs: int, block=True, timeout=0) -> Item | None:
         """Request a work lease the work queue. This should be called by a worker to get work to
@@ -102,39 +287,61 @@ class WorkQueue(object):
         If you've not already done it, it's worth reading [the documentation on leasing
         items](https://github.com/MeVitae/redis-work-queue/blob/main/README.md#leasing-an-item).
         """
+        if not block:
+            # Without blocking, the whole lease can be done in a single script.
+            leased: list | None = self._script(db, self._LEASE_LUA)(
+                keys=[self._main_queue_key, self._processing_key],
+                args=[
+                    self._lease_key.prefix,
+                    self._item_data_key.prefix,
+                    lease_secs,
+                    self._session,
+                    1 if self._supports_lmove(db) else 0,
+                ],
+                client=db,
+            )
+            if leased is None:
+                return None
+            item_id, data = leased
+            item = Item(data, id=item_id)
+            self._keys_for(item)
+            return item
+
         # First, to get an item, we try to move an item from the main queue to the processing list.
-        if block:
-            maybe_item_id: bytes | str | None = db.brpoplpush(
+        # Blocking commands can't be used in scripts, so this is a separate round trip.
+        # The id is used as returned by redis (normally bytes), there's no need to decode it.
+        if self._supports_lmove(db):
+            item_id: bytes | str | None = db.blmove(
                 self._main_queue_key,
                 self._processing_key,
-                timeout=timeout,
+                timeout,
+                src='RIGHT',
+                dest='LEFT',
             )
         else:
-            maybe_item_id: bytes | str | None = db.rpoplpush(
+            item_id: bytes | str | None = db.brpoplpush(
                 self._main_queue_key,
                 self._processing_key,
+                timeout=timeout,
             )
-
-        if maybe_item_id is None:
+        if item_id is None:
             return None
 
-        # Make sure the item id is a string
-        if isinstance(maybe_item_id, bytes):
-            item_id: str = maybe_item_id.decode('utf-8')
-        elif isinstance(maybe_item_id, str):
-            item_id: str = maybe_item_id
-        else:
-            raise Exception("item id from work queue not bytes or string")
+        lease_key = self._lease_key.of(item_id)
+        item_data_key = self._item_data_key.of(item_id)
 
-        # If we got an item, fetch the associated data.
-        data: bytes | None = db.get(self._item_data_key.of(item_id))
+        # If we got an item, fetch the associated data and setup the lease in one round trip.
+        # NOTE: Racing for a lease is ok.
+        pipeline = db.pipeline(transaction=False)
+        pipeline.get(item_data_key)
+        pipeline.setex(lease_key, lease_secs, self._session)
+        data, _ = pipeline.execute()
         if data is None:
             data = bytes()
 
-        # Setup the lease item.
-        # NOTE: Racing for a lease is ok.
-        db.setex(self._lease_key.of(item_id), lease_secs, self._session)
-        return Item(data, id=item_id)
+        item = Item(data, id=item_id)
+        item._key_cache = (self, lease_key, item_data_key)
+        return item
 
     def complete(self, db: Redis, item: Item) -> bool:
         """Marks a job as completed and remove it from the work queue. After `complete` has been
@@ -143,17 +350,14 @@ class WorkQueue(object):
         `complete` returns a boolean indicating if *the job has been removed* **and** *this worker
         was the first worker to call `complete`*. So, while lease might give the same job to
         multiple workers, complete will return `true` for only one worker."""
-        removed = int(db.lrem(self._processing_key, 0, item.id()))
-        # Only complete the work if it was still in the processing queue
-        if removed == 0:
-            return False
-        item_id = item.id()
-        # TODO: The cleaner should also handle these... :(
-        db.pipeline() \
-            .delete(self._item_data_key.of(item_id)) \
-            .delete(self._lease_key.of(item_id)) \
-            .execute()
-        return True
+        lease_key, item_data_key = self._keys_for(item)
+        # TODO: The cleaner should also handle the item data and lease keys... :(
+        removed = self._script(db, self._COMPLETE_LUA)(
+            keys=[self._processing_key, item_data_key, lease_key],
+            args=[item.id()],
+            client=db,
+        )
+        return removed != 0
 
 
 __version__ = "0.1.2"
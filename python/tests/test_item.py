@@ -0,0 +1,83 @@
+import ast
+
+import pytest
+
+from redis_work_queue import Item, set_codec, use_json, use_msgpack, use_orjson
+
+
+def test_item_fields():
+    item = Item(b'abc', id='foo')
+    assert item.data() == b'abc'
+    assert item.id() == 'foo'
+    # Items used to be dicts, so the fields can still be read by key.
+    assert item['data'] == b'abc'
+    assert item['id'] == 'foo'
+    assert item == Item('abc', id='foo')
+    assert item != Item(b'abd', id='foo')
+    assert repr(item) == "Item(data=b'abc', id='foo')"
+
+
+def test_json():
+    item = Item.from_json_data({'n': 7, 's': 'foo', 1: 'one'}, id='foo')
+    assert item.data() == b'{"n":7,"s":"foo","1":"one"}'
+    assert item.data_json() == {'n': 7, 's': 'foo', '1': 'one'}
+    assert Item.from_json_data('é').data() == b'"\\u00e9"'
+    assert Item.from_json_data(2**70).data_json() == 2**70
+    assert Item.parse('{"data":"[1,2,3]","id":"x"}') == Item(b'[1,2,3]', id='x')
+
+
+def test_orjson():
+    pytest.importorskip('orjson')
+    try:
+        use_orjson()
+        item = Item.from_json_data({'n': 7, 1: 'one'})
+        assert item.data() == b'{"n":7,"1":"one"}'
+        assert item.data_json() == {'n': 7, '1': 'one'}
+        # orjson can't serialize this, so it falls back to the standard library.
+        assert Item.from_json_data(2**70).data_json() == 2**70
+    finally:
+        use_json()
+
+
+def test_codec_round_trip():
+    try:
+        set_codec(repr, lambda data: ast.literal_eval(data.decode('utf-8')))
+        item = Item.from_json_data({'n': (1, 2)})
+        assert item.data() == b"{'n': (1, 2)}"
+        assert item.data_json() == {'n': (1, 2)}
+    finally:
+        use_json()
+    assert Item.from_json_data({'n': [1, 2]}).data() == b'{"n":[1,2]}'
+
+
+def test_msgpack():
+    pytest.importorskip('msgpack')
+    try:
+        use_msgpack()
+        item = Item.from_json_data({'n': [1, 2], 's': 'foo'})
+        assert item.data() == b'\x82\xa1n\x92\x01\x02\xa1s\xa3foo'
+        assert item.data_json() == {'n': [1, 2], 's': 'foo'}
+    finally:
+        use_json()
+    assert Item.from_json_data({'n': [1, 2]}).data_json() == {'n': [1, 2]}
+
+
+def test_ids():
+    assert len(Item(b'').id()) == 32
+    assert Item(b'', id=7).id() == '7'
+    assert Item(b'', id=b'7').id() == b'7'
+    # Leased items have bytes ids, they should still equal the item that was added.
+    assert Item(b'x', id='abc') == Item(b'x', id=b'abc')
+    assert Item(b'x', id='abc') != Item(b'x', id=b'abd')
+
+
+def test_data_conversion():
+    class Name(str):
+        pass
+
+    assert Item(b'abc').data() == b'abc'
+    assert Item('abc').data() == b'abc'
+    assert Item(bytearray(b'abc')).data() == b'abc'
+    assert Item([1, 2, 3]).data() == b'\x01\x02\x03'
+    # Subclasses miss the type table, and fall back to the isinstance checks.
+    assert Item(Name('é')).data() == 'é'.encode('utf-8')
@@ -0,0 +1,186 @@
+import pytest
+from redis.exceptions import ResponseError
+
+from redis_work_queue import Item, KeyPrefix, WorkQueue
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def db():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def queue():
+    return WorkQueue(KeyPrefix('test'))
+
+
+def expire_lease(db, queue: WorkQueue, item: Item):
+    db.delete(queue._lease_key.of(item.id()))
+
+
+def test_add_items(db, queue):
+    # 25 items in chunks of 10 leaves a partially full final pipeline.
+    items = [Item(bytes([n])) for n in range(25)]
+    queue.add_items(db, items, chunk=10)
+    assert queue.queue_len(db) == 25
+
+    leased = [queue.lease(db, 10, block=False) for _ in items]
+    assert sorted(item.data() for item in leased) == [item.data() for item in items]
+    assert queue.lease(db, 10, block=False) is None
+
+    queue.add_items(db, [], chunk=10)
+    assert queue.queue_len(db) == 0
+    with pytest.raises(ValueError):
+        queue.add_items(db, items, chunk=0)
+
+
+def test_light_clean(db, queue):
+    queue.add_items(db, [Item(b'a', id='expired'), Item(b'b', id='leased')])
+    leased = {item.id(): item for item in (queue.lease(db, 10, block=False) for _ in range(2))}
+    expire_lease(db, queue, leased[b'expired'])
+
+    queue.light_clean(db)
+    assert db.lrange(queue._main_queue_key, 0, -1) == [b'expired']
+    assert db.lrange(queue._processing_key, 0, -1) == [b'leased']
+
+
+def test_light_clean_drops_completed_items(db, queue):
+    queue.add_item(db, Item(b'a', id='done'))
+    done = queue.lease(db, 10, block=False)
+    assert queue.complete(db, done)
+    # A cleaner crashed with the item in the cleaning list, but it's since been completed.
+    db.lpush(queue._cleaning_key, done.id())
+
+    queue.light_clean(db)
+    assert db.keys('*') == []
+
+
+def test_complete(db, queue):
+    queue.add_item(db, Item(b'data'))
+    leased = queue.lease(db, 10, block=False)
+    assert queue.complete(db, leased)
+    # Only the first call completes the item.
+    assert not queue.complete(db, leased)
+    assert queue.processing(db) == 0
+    assert db.keys('*') == []
+
+
+def test_complete_after_reset(db, queue):
+    queue.add_item(db, Item(b'data'))
+    leased = queue.lease(db, 10, block=False)
+    expire_lease(db, queue, leased)
+    queue.light_clean(db)
+    # The item went back to the main queue, so its data must be kept.
+    assert not queue.complete(db, leased)
+    assert queue.lease(db, 10, block=False).data() == b'data'
+
+
+def test_lease(db, queue):
+    added = Item(b'data')
+    queue.add_item(db, added)
+    leased = queue.lease(db, 10, block=False)
+    assert leased == added
+    assert queue.queue_len(db) == 0
+    assert queue.processing(db) == 1
+    assert db.ttl(queue._lease_key.of(leased.id())) > 0
+    assert queue.lease(db, 10, block=False) is None
+
+
+def test_blocking_lease(db, queue):
+    queue.add_item(db, Item(b'data'))
+    leased = queue.lease(db, 10, timeout=1)
+    assert leased.data() == b'data'
+    assert db.ttl(queue._lease_key.of(leased.id())) > 0
+    assert queue.lease(db, 10, timeout=1) is None
+
+
+def test_leased_ids_are_bytes(db, queue):
+    added = Item(b'data', id='foo')
+    queue.add_item(db, added)
+    leased = queue.lease(db, 10, block=False)
+    assert leased.id() == b'foo'
+    assert leased == added
+    assert KeyPrefix('result:').of(leased.id()) == b'result:foo'
+
+
+@pytest.mark.parametrize('version, expected', [
+    ('6.0.16', False),
+    ('6.2.0', True),
+    ('7.2.4', True),
+    ('unknown', False),
+])
+def test_supports_lmove(db, queue, monkeypatch, version, expected):
+    monkeypatch.setattr(db, 'info', lambda section=None: {'redis_version': version})
+    assert queue._supports_lmove(db) is expected
+
+
+@pytest.mark.parametrize('block', [False, True])
+def test_lease_without_lmove(db, queue, monkeypatch, block):
+    # INFO is commonly denied by ACLs, which should fall back to (B)RPOPLPUSH.
+    def info(section=None):
+        raise ResponseError("NOPERM this user has no permissions to run the 'info' command")
+    monkeypatch.setattr(db, 'info', info)
+
+    added = Item(b'data')
+    queue.add_item(db, added)
+    leased = queue.lease(db, 10, block=block, timeout=1)
+    assert queue._has_lmove is False
+    assert leased == added
+    assert leased.data() == b'data'
+    assert db.exists(queue._lease_key.of(leased.id()))
+    assert queue.processing(db) == 1
+    assert queue.complete(db, leased)
+
+
+def test_light_clean_in_chunks(db, queue):
+    queue.add_items(db, [Item(b'', id=str(n)) for n in range(7)])
+    leased = [queue.lease(db, 10, block=False) for _ in range(7)]
+    for item in leased[::2]:
+        expire_lease(db, queue, item)
+    processing = db.lrange(queue._processing_key, 0, -1)
+
+    # A chunk that doesn't divide the list exercises the final partial LRANGE.
+    queue.light_clean(db, chunk=2)
+    assert db.lrange(queue._processing_key, 0, -1) == [
+        id for id in processing if id not in {item.id() for item in leased[::2]}
+    ]
+    assert sorted(db.lrange(queue._main_queue_key, 0, -1)) == sorted(
+        item.id() for item in leased[::2]
+    )
+
+    before = db.lrange(queue._processing_key, 0, -1), db.lrange(queue._main_queue_key, 0, -1)
+    queue.light_clean(db, chunk=2)
+    assert (db.lrange(queue._processing_key, 0, -1), db.lrange(queue._main_queue_key, 0, -1)) \
+        == before
+
+    with pytest.raises(ValueError):
+        queue.light_clean(db, chunk=0)
+
+
+def test_light_clean_large_chunk(db, queue):
+    # More kept ids than fit in one RPUSH, so the script has to push them back in batches.
+    queue.add_items(db, [Item(b'', id=str(n)) for n in range(2500)])
+    leased = [queue.lease(db, 10, block=False) for _ in range(2500)]
+    expire_lease(db, queue, leased[0])
+    processing = db.lrange(queue._processing_key, 0, -1)
+
+    queue.light_clean(db, chunk=5000)
+    assert db.lrange(queue._processing_key, 0, -1) == processing[:-1]
+    assert db.lrange(queue._main_queue_key, 0, -1) == [leased[0].id()]
+
+
+def test_light_clean_forgotten_items(db, queue):
+    queue.add_items(db, [Item(b'', id=id) for id in ('lost', 'done', 'leased')])
+    leased = {item.id(): item for item in (queue.lease(db, 10, block=False) for _ in range(3))}
+    # A cleaner crashed between removing 'lost' from processing and requeueing it.
+    db.lrem(queue._processing_key, 0, b'lost')
+    expire_lease(db, queue, leased[b'lost'])
+    assert queue.complete(db, leased[b'done'])
+    db.lpush(queue._cleaning_key, b'lost', b'done', b'leased', b'lost')
+
+    queue.light_clean(db)
+    assert db.llen(queue._cleaning_key) == 0
+    assert db.lrange(queue._main_queue_key, 0, -1) == [b'lost']
+    assert db.lrange(queue._processing_key, 0, -1) == [b'leased']